@@ -2,7 +2,20 @@ import streamlit as st
 import random
 import re
 from google import genai
-import ast
+import json
+
+# --- 正規表現 (毎回コンパイルしないようにモジュール読み込み時に用意) ---
+_SPLIT_RE = re.compile(r'(\b\w+\b)')
+# 穴のマーカー。ユーザーが入力した英文と衝突しないようNUL文字で囲む
+_GAP_RE = re.compile(r'\x00GAP_(\d+)\x00')
+
+# Geminiの回答として受け付ける最大文字数 (暴走した出力は途中で打ち切る)
+_MAX_RESPONSE_CHARS = 4096
+
+
+# Geminiの回答内容そのものに問題がある場合の例外 (API・設定のエラーとは区別する)
+class _InvalidResponseError(Exception):
+    pass
 
 # --- Streamlit UI設定 ---
 st.set_page_config(page_title="模擬Intakeテスト", layout="wide")
@@ -10,98 +23,112 @@ st.title("模擬Intakeテスト (英語 文法・語彙)")
 st.subheader("抜き出された語句を正しい位置に**コピー＆ペースト**で埋めるテストです。")
 
 # --- 初期化 (全てのキーの存在を保証) ---
-if 'test_started' not in st.session_state:
-    st.session_state.test_started = False
-if 'score' not in st.session_state:
-    st.session_state.score = None
-if 'user_answers' not in st.session_state:
-    st.session_state.user_answers = {}
-if 'correct_answers' not in st.session_state:
-    st.session_state.correct_answers = []
-if 'shuffled_words' not in st.session_state:
-    st.session_state.shuffled_words = []
-if 'gap_text_display' not in st.session_state:
-    st.session_state.gap_text_display = ""
-if 'feedback' not in st.session_state:
-    st.session_state.feedback = []
-if 'is_complete' not in st.session_state:
-    st.session_state.is_complete = False
-if 'extracted_words_original_order' not in st.session_state:
-    st.session_state.extracted_words_original_order = []
-
-
-# --- Gemini APIとの連携関数 (抜き出し順表示に修正) ---
+def _default_state():
+    # アプリが管理するキーとその初期値 (ウィジェットが生成するキーは含めない)
+    return {
+        'test_started': False,
+        'score': None,
+        'correct_answers': [],
+        'shuffled_words': [],
+        'gap_text_display': "",
+        'gap_segments': [],
+        'feedback': [],
+        'is_complete': False,
+        'extracted_words_original_order': [],
+    }
+
+
+for key, value in _default_state().items():
+    if key not in st.session_state:
+        st.session_state[key] = value
+
+
+# --- Geminiクライアント (APIキーごとに一度だけ生成し、接続を再利用) ---
+@st.cache_resource
+def _gemini_client(api_key):
+    return genai.Client(api_key=api_key)
+
+
+# --- Gemini API呼び出しと回答解析 (同じ英文・単語数の結果はキャッシュして再利用) ---
+@st.cache_data(ttl=86400, max_entries=256, show_spinner=False)
+def _extract_words_cached(_client, text, num_words):
+    prompt = (
+        f"Return a JSON array of exactly {num_words} words from the text that are grammatically "
+        f"important for high-school learners (relative pronouns, participles, conjunctions, "
+        f"advanced vocabulary).\n{text}"
+    )
+    # ストリーミングで受信し、リストの閉じ括弧が届いた時点で打ち切る
+    response_text = ""
+    for chunk in _client.models.generate_content_stream(
+        model='gemini-2.5-flash', 
+        contents=prompt,
+        config={
+            'response_mime_type': 'application/json',
+            'response_schema': list[str],
+        },
+    ):
+        response_text += chunk.text or ""
+        if ']' in response_text:
+            break
+        if len(response_text) > _MAX_RESPONSE_CHARS:
+            # 例外にしておけば、不正な回答がキャッシュされることもない
+            raise _InvalidResponseError("APIレスポンスが長すぎます。")
+
+    try:
+        extracted_words = json.loads(response_text)
+    except json.JSONDecodeError:
+        # スキーマ指定により通常は起きない (途中で切れた回答など)
+        raise _InvalidResponseError(f"AIの回答解析に失敗しました。AIの回答: {response_text[:50]}...")
+    # 例外にしておけば、想定外の形式の回答がキャッシュされることもない
+    if not isinstance(extracted_words, list) or not all(isinstance(w, str) for w in extracted_words):
+        raise _InvalidResponseError("APIレスポンスが有効なリスト形式ではありません。")
+    return extracted_words
+
+
+# --- Gemini APIとの連携関数 (抜き出す語を小文字化したセットで返す) ---
 def get_word_info_from_gemini(text, num_words):
     if "GEMINI_API_KEY" not in st.secrets:
         st.error("❌ Gemini APIキーが設定されていません。")
-        return [], []
+        return set()
     
     try:
-        api_key = st.secrets["GEMINI_API_KEY"]
-        client = genai.Client(api_key=api_key)
+        client = _gemini_client(st.secrets["GEMINI_API_KEY"])
     except Exception as e:
         st.error(f"❌ Geminiクライアントの初期化に失敗しました: {e}")
-        return [], []
-
-    prompt = (
-        f"以下の英文から、高校生レベルで文法的に重要な語（関係代名詞、分詞、接続詞、高難度語彙など）を正確に{num_words}個、"
-        f"**他の文字を含めずに**Pythonのリスト形式（例: ['word1', 'word2', 'word3']）で抜き出して提供してください。\n\n"
-        f"英文: '{text}'"
-    )
+        return set()
 
     try:
         with st.spinner("Gemini AIが重要な単語を選定中です..."):
-            response = client.models.generate_content(
-                model='gemini-2.5-flash', 
-                contents=prompt
-            )
-        response_text = response.text.strip()
+            extracted_words_from_api = _extract_words_cached(client, text, num_words)
+    except _InvalidResponseError as e:
+        # 回答の内容に問題がある場合 (解析失敗・長すぎる回答)
+        st.warning(f"⚠️ {e}")
+        return set()
     except Exception as e:
         st.error(f"❌ Gemini APIの呼び出し中にエラーが発生しました: {e}")
-        return [], []
-    
-    try:
-        if response_text.startswith('```'):
-            response_text = response_text.replace('```python', '').replace('```json', '').replace('```', '').strip()
-            
-        extracted_words_from_api = ast.literal_eval(response_text)
-        if not isinstance(extracted_words_from_api, list):
-            raise ValueError("APIレスポンスが有効なリスト形式ではありません。")
-    except Exception as e:
-        st.warning(f"⚠️ AIの回答解析に失敗しました。AIの回答: {response_text[:50]}...")
-        return [], []
+        return set()
 
-    all_words = re.findall(r'\b\w+\b', text)
-    final_extracted_words_original_order = []
-    api_words_lower = {w.lower() for w in extracted_words_from_api}
-    
-    for word in all_words:
-        if word.lower() in api_words_lower and word not in final_extracted_words_original_order:
-            final_extracted_words_original_order.append(word)
-
-    # ⚠️ 修正点: シャッフルせずに、抜き出し順のリストをそのまま返す
-    shuffled_words = final_extracted_words_original_order[:] 
-    
-    # 抜き出した順（元の文章に出現した順）の単語リストも返す
-    return final_extracted_words_original_order, shuffled_words
+    # 出現順の並べ替えは create_gap_text が英文を走査する際に同時に行う
+    return {w.casefold() for w in extracted_words_from_api}
 
 
-# --- 穴埋めテキスト生成ロジック (変更なし) ---
-def create_gap_text(text, words_to_hide):
+# --- 穴埋めテキスト生成ロジック ---
+# 英文を一度だけ走査し、穴埋めテキストと、隠した語の出現順リスト (=正解) を作る
+def create_gap_text(text, hide_set):
     correct_positions = []
-    parts = re.split(r'(\b\w+\b)', text)
+    # キャプチャ付きsplitなので、奇数番目の要素は必ず単語になる
+    parts = _SPLIT_RE.split(text)
     gap_count = 0
     new_parts = []
-    hide_set = {w.lower() for w in words_to_hide}
-    words_hidden_in_order = []
+    words_hidden = set()
     
-    for part in parts:
-        is_word = re.match(r'\b\w+\b', part)
-        if is_word and part.lower() in hide_set and part not in words_hidden_in_order:
-            marker = f'[GAP_{gap_count}]'
+    for idx, part in enumerate(parts):
+        is_word = idx % 2 == 1
+        if is_word and part.casefold() in hide_set and part not in words_hidden:
+            marker = f'\x00GAP_{gap_count}\x00'
             new_parts.append(marker)
             correct_positions.append(part)
-            words_hidden_in_order.append(part) 
+            words_hidden.add(part)
             gap_count += 1
         else:
             new_parts.append(part)
@@ -132,31 +159,25 @@ with st.sidebar:
         if not user_input.strip():
             st.warning("英文を入力してください。")
         elif "GEMINI_API_KEY" in st.secrets:
-            # 1. 状態をリセット
-            st.session_state.test_started = False
-            st.session_state.score = None
-            st.session_state.user_answers = {}
-            st.session_state.correct_answers = []
-            st.session_state.shuffled_words = []
-            st.session_state.gap_text_display = ""
-            st.session_state.feedback = []
-            st.session_state.is_complete = False
-            st.session_state.extracted_words_original_order = []
+            # 1. 状態をリセット (アプリのキーだけをまとめて初期値に戻し、前回の回答欄を消す)
+            st.session_state.update(_default_state())
+            for key in [k for k in st.session_state if k.startswith('input_')]:
+                del st.session_state[key]
             
             # 2. Gemini API呼び出し
-            original_words, shuffled_words = get_word_info_from_gemini(user_input, num_words_to_extract)
+            words_to_hide = get_word_info_from_gemini(user_input, num_words_to_extract)
+            gap_text_display, correct_answers = create_gap_text(user_input, words_to_hide)
             
             # 3. 成功した場合のみ状態を更新し、rerunする
-            if original_words:
+            if correct_answers:
                 st.session_state.test_started = True
-                st.session_state.shuffled_words = shuffled_words
-                st.session_state.extracted_words_original_order = original_words # 抜き出し順リストを保存
-                st.session_state.gap_text_display, st.session_state.correct_answers = create_gap_text(
-                    user_input, 
-                    original_words
-                )
-                num_gaps = len(st.session_state.correct_answers)
-                st.session_state.user_answers = {f'gap_{i}': "" for i in range(num_gaps)} 
+                st.session_state.gap_text_display = gap_text_display
+                st.session_state.correct_answers = correct_answers
+                # ⚠️ シャッフルせずに、抜き出し順（元の文章に出現した順）のリストをそのまま使う
+                st.session_state.shuffled_words = correct_answers[:]
+                st.session_state.extracted_words_original_order = correct_answers # 抜き出し順リストを保存
+                # 穴のマーカーで一度だけ分割しておく: [本文0, '0', 本文1, '1', ..., 本文N]
+                st.session_state.gap_segments = _GAP_RE.split(st.session_state.gap_text_display)
                 
                 st.rerun() 
             # 失敗した場合は、エラーメッセージは関数内で表示されているため、ここでは何もしない。
@@ -175,62 +196,50 @@ if st.session_state.test_started and st.session_state.correct_answers:
     st.markdown("### 2. 穴埋め文章 (単語をペーストしてください)")
     
     num_gaps = len(st.session_state.correct_answers)
-    displayed_text = st.session_state.gap_text_display
+    segments = st.session_state.gap_segments
     
-    for i in range(num_gaps):
-        gap_marker = f'[GAP_{i}]'
-        
-        parts_before_gap = displayed_text.split(gap_marker, 1)
-        st.markdown(parts_before_gap[0], unsafe_allow_html=True)
+    # フォーム内の入力は採点ボタンを押すまでrerunを発生させない
+    # (Enterキーでは送信せず、「採点する」ボタンだけで採点する)
+    with st.form('gap_form', enter_to_submit=False):
+        for j in range(0, len(segments) - 1, 2):
+            i = int(segments[j + 1])
+            st.markdown(segments[j], unsafe_allow_html=True)
         
-        col1, col2 = st.columns([1, 10])
-        with col1:
-             st.markdown(f"**[{i+1}]**")
-        with col2:
-             current_answer = st.session_state.user_answers.get(f'gap_{i}', "")
-             
-             # ⚠️ 修正: text_input を使用し、キーを変更
-             selected_word = st.text_input(
-                 "回答", 
-                 value=current_answer,
-                 key=f'input_{i}', # 新しいキーを使用
-                 label_visibility='collapsed',
-             )
-             # text_inputの値が変更されたらセッションステートを即座に更新 (ドラッグ&ドロップのセーブに近い挙動)
-             st.session_state.user_answers[f'gap_{i}'] = selected_word
-             
-        if len(parts_before_gap) > 1:
-            displayed_text = parts_before_gap[1]
-
-    st.markdown(displayed_text)
+            col1, col2 = st.columns([1, 10])
+            with col1:
+                 st.markdown(f"**[{i+1}]**")
+            with col2:
+                 # 回答はキー input_{i} でStreamlitが保持するため、採点時に直接読み出す
+                 st.text_input(
+                     "回答", 
+                     key=f'input_{i}',
+                     label_visibility='collapsed',
+                 )
+
+        st.markdown(segments[-1])
     
-    st.markdown("---")
-
-    if st.button("採点する", key='score_button'):
-        score = 0
-        feedback = []
-        is_complete = True
-        
-        for i, correct_word in enumerate(st.session_state.correct_answers):
-            # 採点時は大文字・小文字を区別しない
-            user_word = st.session_state.user_answers.get(f'gap_{i}', "").strip()
-            
-            if not user_word:
-                feedback.append(f"穴 {i+1} : **未回答**")
-                is_complete = False
-                continue
-                
-            if user_word.lower() == correct_word.lower(): # 大文字・小文字を無視
-                score += 1
-                feedback.append(f"穴 {i+1} ({user_word}) : **正解** ✅")
-            else:
-                feedback.append(f"穴 {i+1} ({user_word}) : **不正解** ❌ (正解: {correct_word})")
-        
-        st.session_state.score = score
-        st.session_state.feedback = feedback
-        st.session_state.is_complete = is_complete
+        st.markdown("---")
+
+        submitted = st.form_submit_button("採点する")
+
+    if submitted:
+        ss = st.session_state
+        # (穴番号, 正解, 回答) を一度だけ集める。採点時は大文字・小文字を区別しない
+        answers = [
+            (i, correct_word, ss.get(f'input_{i}', "").strip())
+            for i, correct_word in enumerate(ss.correct_answers)
+        ]
+        is_correct = [bool(u) and u.casefold() == c.casefold() for _, c, u in answers]
         
-        st.rerun()
+        ss.score = sum(is_correct)
+        ss.feedback = [
+            f"穴 {i+1} : **未回答**" if not u
+            else f"穴 {i+1} ({u}) : **正解** ✅" if ok
+            else f"穴 {i+1} ({u}) : **不正解** ❌ (正解: {c})"
+            for (i, c, u), ok in zip(answers, is_correct)
+        ]
+        ss.is_complete = all(u for _, _, u in answers)
+        # 採点結果は直後のブロックでこの実行中にそのまま表示されるため、rerunは不要
         
     if st.session_state.score is not None:
         st.markdown("### 採点結果")